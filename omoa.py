@@ -1,27 +1,32 @@
 import asyncio
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import argparse
+import functools
+import io
+import hashlib
+import re
+import sqlite3
+import numpy as np
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 import os
-from utils import generate_together, generate_with_references, generate_together_stream
-from trafilatura import fetch_url, extract
+from utils import generate_together, generate_with_references, generate_with_references_async, generate_together_stream, get_async_client
 import json
+from cachetools import TTLCache
 from colorama import Fore, Style, init
 import time
 from MemoryAssistant.prompts import wrap_user_message_in_xml_tags_json_mode
 from llama_cpp_agent.agent_memory.memory_tools import AgentCoreMemory, AgentRetrievalMemory, AgentEventMemory
 from llama_cpp_agent.chat_history.messages import Roles
 from llama_cpp_agent.agent_memory.event_memory import Event
-from duckduckgo_search import DDGS
-from ragatouille.utils import get_wikipedia_page
 from llama_cpp_agent.llm_output_settings import LlmStructuredOutputSettings, LlmStructuredOutputType
 from llama_cpp_agent.messages_formatter import MessagesFormatterType
-from llama_cpp_agent.rag.rag_colbert_reranker import RAGColbertReranker
-from llama_cpp_agent.text_utils import RecursiveCharacterTextSplitter
-import PyPDF2
 import csv
 
+# Heavy modules (trafilatura, duckduckgo_search, PyPDF2, the ColBERT reranker and
+# its torch/transformers stack) are imported lazily at first use so short-lived
+# CLI invocations don't pay their import cost.
+
 # Load environment variables
 load_dotenv()
 
@@ -69,19 +74,18 @@ DEFAULT_PROMPTS = {
     """.strip()
 }
 
-def get_website_content_from_url(url: str) -> str:
+def _extract_content(html: str, url: str) -> str:
     try:
+        from trafilatura import extract
+        from trafilatura.settings import use_config
+
         # Configure trafilatura to be more lenient
         config = use_config()
         config.set("DEFAULT", "EXTRACTION_TIMEOUT", "30")
         config.set("DEFAULT", "MIN_OUTPUT_SIZE", "100")
         config.set("DEFAULT", "MIN_EXTRACTED_SIZE", "100")
 
-        downloaded = fetch_url(url)
-        if downloaded is None:
-            return f"Failed to fetch content from {url}"
-
-        result = extract(downloaded, include_formatting=True, include_links=True, output_format='json', url=url, config=config)
+        result = extract(html, include_formatting=True, include_links=True, output_format='json', url=url, config=config)
         
         if result:
             result_dict = json.loads(result)
@@ -99,46 +103,404 @@ def get_website_content_from_url(url: str) -> str:
     except Exception as e:
         return f"An error occurred while processing {url}: {str(e)}"
 
-def search_web(search_query: str):
-    results = DDGS().text(search_query, region='wt-wt', safesearch='off', timelimit='y', max_results=3)
+# Matches the legacy search directive emitted by reference agents, e.g. [SEARCH: query]
+_SEARCH_RE = re.compile(r"\[SEARCH:([^\]]+)\]")
+
+_SEARCH_PROTOCOL_PROMPT = (
+    "If you need current information from the web to answer, respond with ONLY the JSON object "
+    '{"search": "<query>"} and nothing else. Otherwise, answer the question directly.'
+)
+
+_sentence_embedder = None
+
+def get_sentence_embedder():
+    """Return the shared sentence-transformers model, loading it on first use."""
+    global _sentence_embedder
+    if _sentence_embedder is None:
+        import torch
+        from sentence_transformers import SentenceTransformer
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        _sentence_embedder = SentenceTransformer("all-MiniLM-L6-v2", device=device)
+        if device == "cuda":
+            _sentence_embedder.half()
+    return _sentence_embedder
+
+async def _to_thread_fast(fn, *args, **kwargs):
+    """Like asyncio.to_thread but without the contextvars copy_context() wrapping,
+    which is pure overhead here since this module never sets contextvars."""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+class ResponseCache:
+    """Two-tier cache for LLM responses: exact hash on the full message list,
+    with a semantic fallback based on embedding similarity of the user message.
+
+    The semantic tier is partitioned by a caller-supplied namespace (derived
+    from the agent's prompt shape), since the reference agents all receive the
+    same user message and must not resolve to each other's responses.
+    Entries are persisted to a SQLite file so the cache survives restarts."""
+
+    def __init__(self, cache_file: str, similarity_threshold: float = 0.92):
+        self.cache_file = cache_file
+        self.similarity_threshold = similarity_threshold
+        self._exact = {}
+        self._embeddings = {}  # namespace -> (n_entries, dim) matrix of normalized embeddings
+        self._responses = {}  # namespace -> responses aligned with the embedding rows
+        self._init_db()
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        self._db = sqlite3.connect(self.cache_file, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, namespace TEXT, user_message TEXT, response TEXT, embedding BLOB)"
+        )
+        self._db.commit()
+        try:
+            rows = list(self._db.execute("SELECT key, namespace, response, embedding FROM responses"))
+        except sqlite3.OperationalError:
+            # Cache file predates the namespace column; discard it rather than
+            # carry entries that can't be partitioned
+            self._db.execute("DROP TABLE responses")
+            self._db.execute(
+                "CREATE TABLE responses (key TEXT PRIMARY KEY, namespace TEXT, user_message TEXT, response TEXT, embedding BLOB)"
+            )
+            self._db.commit()
+            rows = []
+        for key, namespace, response, embedding in rows:
+            self._exact[key] = response
+            if embedding is not None:
+                self._add_embedding(namespace, np.frombuffer(embedding, dtype=np.float32), response)
+
+    def _embed(self, text: str) -> np.ndarray:
+        return get_sentence_embedder().encode(text, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+    def _add_embedding(self, namespace: str, embedding: np.ndarray, response: str):
+        row = embedding.reshape(1, -1)
+        if namespace not in self._embeddings:
+            self._embeddings[namespace] = row
+            self._responses[namespace] = []
+        else:
+            self._embeddings[namespace] = np.vstack([self._embeddings[namespace], row])
+        self._responses[namespace].append(response)
+
+    @staticmethod
+    def make_key(messages: List[dict]) -> str:
+        return hashlib.blake2b(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str, user_message: str, namespace: str) -> Optional[str]:
+        exact_hit = self._exact.get(key)
+        if exact_hit is not None:
+            return exact_hit
+        embeddings = self._embeddings.get(namespace)
+        if embeddings is None:
+            return None
+        similarities = embeddings @ self._embed(user_message)
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.similarity_threshold:
+            return self._responses[namespace][best]
+        return None
+
+    def put(self, key: str, user_message: str, response: str, namespace: str):
+        if key in self._exact:
+            return
+        self._exact[key] = response
+        embedding = self._embed(user_message)
+        self._add_embedding(namespace, embedding, response)
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses (key, namespace, user_message, response, embedding) VALUES (?, ?, ?, ?, ?)",
+            (key, namespace, user_message, response, embedding.tobytes()),
+        )
+        self._db.commit()
+
+_response_cache = None
+
+def get_response_cache() -> ResponseCache:
+    global _response_cache
+    if _response_cache is None:
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        _response_cache = ResponseCache(os.path.join(current_dir, "MemoryAssistant", "response_cache.sqlite"))
+    return _response_cache
+
+async def fetch_all(urls: List[str]) -> List:
+    client = get_async_client()
+    return await asyncio.gather(*(client.get(url) for url in urls), return_exceptions=True)
+
+# Shared DDGS instance (reuses its HTTP session across calls) and short-TTL caches,
+# since the same queries and URLs recur within and across get_response calls
+_ddgs = None
+_search_cache = TTLCache(maxsize=512, ttl=600)
+_url_content_cache = TTLCache(maxsize=512, ttl=600)
+
+def _get_ddgs():
+    global _ddgs
+    if _ddgs is None:
+        from duckduckgo_search import DDGS
+        _ddgs = DDGS()
+    return _ddgs
+
+async def search_web(search_query: str) -> str:
+    cache_key = hashlib.blake2b(search_query.encode("utf-8")).hexdigest()
+    cached = _search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    results = await _to_thread_fast(
+        _get_ddgs().text, search_query, region='wt-wt', safesearch='off', timelimit='y', max_results=3
+    )
+    urls = [res['href'] for res in results]
+    # Snapshot cached contents before the fetch: a TTL entry could expire during
+    # the await, and a second cache lookup would then miss a URL we never fetched
+    cached_contents = {url: _url_content_cache.get(url) for url in urls}
+    to_fetch = [url for url, content in cached_contents.items() if content is None]
+    responses = dict(zip(to_fetch, await fetch_all(to_fetch)))
     result_string = ''
-    for res in results:
-        web_info = get_website_content_from_url(res['href'])
+    fetch_failed = False
+    for url in urls:
+        web_info = cached_contents[url]
+        if web_info is None:
+            response = responses[url]
+            if isinstance(response, Exception) or response.is_error:
+                # Don't cache failures, so transient errors get retried next time
+                web_info = f"Failed to fetch content from {url}"
+                fetch_failed = True
+            else:
+                # Extraction is pure CPU on already-downloaded HTML, so keep it off the event loop
+                web_info = await _to_thread_fast(_extract_content, response.text, url)
+                _url_content_cache[url] = web_info
         result_string += web_info + "\n\n"
-    
+
     if result_string.strip():
-        return "Based on the following results:\n\n" + result_string
+        result = "Based on the following results:\n\n" + result_string
     else:
-        return "No relevant information found from the web search."
+        result = "No relevant information found from the web search."
+    # Cache the aggregate only when every fetch succeeded; otherwise a repeat of
+    # the query within the TTL would replay the failure text instead of retrying
+    if not fetch_failed:
+        _search_cache[cache_key] = result
+    return result
+
+class ArchivalRag:
+    """Wraps RAGColbertReranker with batched inserts and a cheap embedding prefilter.
+
+    ColBERT MaxSim scoring is O(docs x query_tokens x doc_tokens) over the whole
+    collection on every retrieval. Once the collection grows past
+    PREFILTER_THRESHOLD documents, retrieval instead ranks by inner product over
+    mean-pooled sentence-transformer embeddings; the reranker exposes no
+    candidate-subset API, so the prefilter ranking serves directly for large
+    collections while small ones keep full ColBERT scoring.
+    """
+
+    PREFILTER_THRESHOLD = 50
+
+    def __init__(self, rag, state_dir: Optional[str] = None):
+        self.rag = rag
+        self._documents = []
+        self._embeddings = None  # (n_docs, dim) tensor of normalized embeddings
+        self._query_emb_cache = TTLCache(maxsize=256, ttl=600)
+        self.state_dir = state_dir
+        self._dirty = False
+        if state_dir is not None:
+            self._load_state()
+
+    def _state_files(self):
+        return (
+            os.path.join(self.state_dir, "documents.json"),
+            os.path.join(self.state_dir, "embeddings.npy"),
+        )
+
+    def _load_state(self):
+        docs_file, embs_file = self._state_files()
+        if os.path.exists(docs_file) and os.path.exists(embs_file):
+            with open(docs_file, "r") as f:
+                self._documents = json.load(f)
+            self._embeddings = self._as_matrix(np.load(embs_file).astype(np.float32))
+
+    def save_state(self):
+        """Flush pending index state to disk if anything changed since the last save.
+
+        Saving rewrites the whole document list and embedding matrix, so it is
+        called at upload and chat-turn boundaries rather than per insert.
+        """
+        if not self._dirty:
+            return
+        if self.state_dir is None or self._embeddings is None:
+            return
+        os.makedirs(self.state_dir, exist_ok=True)
+        docs_file, embs_file = self._state_files()
+        with open(docs_file, "w") as f:
+            json.dump(self._documents, f)
+        np.save(embs_file, self._embeddings.float().cpu().numpy())
+        self._dirty = False
+
+    @staticmethod
+    def _as_matrix(embeddings: np.ndarray):
+        # Keep the matrix in fp16 on the GPU when one is available: halves the
+        # memory footprint and bandwidth of the scoring matmul. CPU stays fp32,
+        # where half precision has no fast path.
+        import torch
+        rows = torch.from_numpy(embeddings)
+        if torch.cuda.is_available():
+            rows = rows.cuda().half()
+        return rows
+
+    def add_document(self, document: str):
+        self.add_documents([document])
+
+    def add_documents(self, documents: List[str]):
+        if not documents:
+            return
+        import torch
+        # One batched encode call instead of re-encoding per chunk
+        embeddings = get_sentence_embedder().encode(
+            documents, batch_size=64, normalize_embeddings=True, convert_to_numpy=True
+        ).astype(np.float32)
+        rows = self._as_matrix(embeddings)
+        if self._embeddings is None:
+            self._embeddings = rows
+        else:
+            self._embeddings = torch.cat([self._embeddings, rows])
+        self._documents.extend(documents)
+        # The underlying reranker only exposes per-document inserts
+        for document in documents:
+            self.rag.add_document(document)
+        self._dirty = True
+
+    def embed_query(self, query: str) -> np.ndarray:
+        cached = self._query_emb_cache.get(query)
+        if cached is None:
+            cached = get_sentence_embedder().encode(
+                query, normalize_embeddings=True, convert_to_numpy=True
+            ).astype(np.float32)
+            self._query_emb_cache[query] = cached
+        return cached
+
+    def retrieve_documents(self, query: str, k: int):
+        import torch
+        if self._embeddings is None or len(self._documents) <= self.PREFILTER_THRESHOLD:
+            return self.rag.retrieve_documents(query, k=k)
+        query_embedding = torch.from_numpy(self.embed_query(query)).to(
+            self._embeddings.device, self._embeddings.dtype
+        )
+        scores = self._embeddings @ query_embedding
+        top = torch.topk(scores, min(k, len(self._documents))).indices.tolist()
+        return [{"content": self._documents[i]} for i in top]
+
+    def retrieve_documents_batch(self, queries: List[str], k: int):
+        """Retrieve for several queries at once, deduplicated in first-seen order.
+
+        Above the prefilter threshold this embeds all queries in one batched
+        encode call and scores them against the document matrix with a single
+        matmul instead of one embed + search round-trip per query.
+        """
+        if not queries:
+            return []
+        documents = []
+        if self._embeddings is None or len(self._documents) <= self.PREFILTER_THRESHOLD:
+            seen = set()
+            for query in queries:
+                for doc in self.rag.retrieve_documents(query, k=k):
+                    if doc["content"] not in seen:
+                        seen.add(doc["content"])
+                        documents.append(doc)
+            return documents
+        import torch
+        query_embeddings = get_sentence_embedder().encode(
+            queries, batch_size=16, normalize_embeddings=True, convert_to_numpy=True
+        ).astype(np.float32)
+        query_matrix = torch.from_numpy(query_embeddings).to(
+            self._embeddings.device, self._embeddings.dtype
+        )
+        scores = query_matrix @ self._embeddings.T  # (n_queries, n_docs)
+        top = torch.topk(scores, min(k, len(self._documents)), dim=1).indices.tolist()
+        seen = set()
+        for row in top:
+            for index in row:
+                if index not in seen:
+                    seen.add(index)
+                    documents.append({"content": self._documents[index]})
+        return documents
+
+    def clear_documents(self):
+        self.rag.clear_documents()
+        self._documents = []
+        self._embeddings = None
+        self._query_emb_cache.clear()
+        self._dirty = False
+        if self.state_dir is not None:
+            for state_file in self._state_files():
+                if os.path.exists(state_file):
+                    os.remove(state_file)
 
 class OllamaAgent:
-    def __init__(self, model: str, name: str, system_prompt: str):
+    def __init__(self, model: str, name: str, system_prompt: str, use_search_protocol: bool = False):
         self.model = model
         self.name = name
         self.system_prompt = system_prompt
+        # Only agents that should answer questions get the web-search protocol;
+        # utility agents like query extension keep their bare system prompt
+        self.use_search_protocol = use_search_protocol
+        # Built once so every generate_response call reuses the same dict
+        # instead of allocating an identical one per call
+        self._system_message = {"role": "system", "content": system_prompt}
+        # Semantic cache lookups only match entries from the same prompt shape
+        self._cache_namespace = hashlib.blake2b(
+            f"{system_prompt}\x00{use_search_protocol}".encode("utf-8")
+        ).hexdigest()
+
+    @staticmethod
+    def _extract_search_query(response) -> Optional[str]:
+        if not isinstance(response, str):
+            return None
+        stripped = response.strip()
+        if stripped.startswith("{"):
+            try:
+                query = json.loads(stripped).get("search")
+                if isinstance(query, str) and query.strip():
+                    return query.strip()
+            except (json.JSONDecodeError, AttributeError):
+                pass
+        # Legacy directive for models that ignore the JSON protocol
+        match = _SEARCH_RE.search(response)
+        if match:
+            return match.group(1).strip()
+        return None
 
     async def generate_response(self, message: str) -> Tuple[str, bool]:
-        messages = [
-            {"role": "system", "content": self.system_prompt},
-            {"role": "user", "content": message}
-        ]
-        response = await asyncio.to_thread(generate_with_references, self.model, messages)
-        
+        messages = [self._system_message]
+        if self.use_search_protocol:
+            messages.append({"role": "system", "content": _SEARCH_PROTOCOL_PROMPT})
+        messages.append({"role": "user", "content": message})
+        cache = get_response_cache()
+        cache_key = cache.make_key(messages)
+        cached_response = cache.get(cache_key, message, self._cache_namespace)
+        if cached_response is not None:
+            return cached_response, False
+
+        response = await generate_with_references_async(self.model, messages)
+
         web_search_performed = False
-        if isinstance(response, str) and "[SEARCH:" in response:
+        search_query = self._extract_search_query(response) if self.use_search_protocol else None
+        if search_query:
             web_search_performed = True
-            search_query = response.split("[SEARCH:", 1)[1].split("]", 1)[0].strip()
-            search_results = search_web(search_query)
-            messages.append({"role": "assistant", "content": response})
-            messages.append({"role": "user", "content": f"Here are the search results for '{search_query}':\n\n{search_results}\n\nPlease provide an updated response based on this information."})
-            response = await asyncio.to_thread(generate_with_references, self.model, messages)
+            search_results = await search_web(search_query)
+            # Keep the follow-up prompt short: system prompt, results and question
+            # only, instead of replaying the whole previous turn as well
+            followup = [
+                self._system_message,
+                {"role": "user", "content": f"Here are the web search results for '{search_query}':\n\n{search_results}\n\nUsing this information, answer the original question: {message}"}
+            ]
+            response = await generate_with_references_async(self.model, followup)
         
-        # Try to parse the response as JSON
-        try:
-            json_response = json.loads(response)
-            return json.dumps(json_response), web_search_performed
-        except json.JSONDecodeError:
-            return response, web_search_performed
+        # Normalize JSON responses; most LLM output is plain text, so a cheap
+        # prefix check skips the parse + reserialize attempt entirely
+        if isinstance(response, str) and response.lstrip().startswith(("{", "[")):
+            try:
+                response = json.dumps(json.loads(response))
+            except json.JSONDecodeError:
+                pass
+
+        if isinstance(response, str) and not response.startswith("Error:"):
+            cache.put(cache_key, message, response, self._cache_namespace)
+        return response, web_search_performed
 
 class QueryItem(BaseModel):
     query: str
@@ -170,16 +532,32 @@ class OllamaMixtureOfAgents:
 
         self.agent_core_memory = AgentCoreMemory(["persona", "user", "scratchpad"], core_memory_file=self.core_memory_file)
         self.agent_event_memory = AgentEventMemory()
-        
+
+        # Serialized core memory, rebuilt lazily and invalidated on edits
+        self._core_memory_json = None
+
         # Load core memory
         self.core_memory = self.load_core_memory()
         
-        # Initialize RAG components
-        self.rag = RAGColbertReranker(persistent=False)
+        # Initialize RAG components; the index persists under retrieval_memory so
+        # restarts don't require re-uploading and re-encoding every document
+        from llama_cpp_agent.rag.rag_colbert_reranker import RAGColbertReranker
+        from llama_cpp_agent.text_utils import RecursiveCharacterTextSplitter
+
+        rag_dir = os.path.join(current_dir, "retrieval_memory")
+        self.rag = ArchivalRag(
+            RAGColbertReranker(persistent=True, persistent_db_path=rag_dir),
+            state_dir=rag_dir
+        )
+        self._count_file = os.path.join(rag_dir, "count.json")
         self.document_count = 0  # Add this line to keep track of document count
+        if os.path.exists(self._count_file):
+            with open(self._count_file, "r") as f:
+                self.document_count = json.load(f).get("document_count", 0)
+        self.chunk_size = 512
         self.splitter = RecursiveCharacterTextSplitter(
             separators=["\n\n", "\n", " ", ""],
-            chunk_size=512,
+            chunk_size=self.chunk_size,
             chunk_overlap=0,
             length_function=len,
             keep_separator=True
@@ -187,6 +565,9 @@ class OllamaMixtureOfAgents:
 
         self.primary_model = final_agent.model  # Add this line
 
+        # Shared async HTTP client so all LLM calls reuse one connection pool
+        self.http_client = get_async_client()
+
     def update_memory(self, message, role):
         # Update event memory
         self.agent_event_memory.add_event(role, message)
@@ -195,19 +576,19 @@ class OllamaMixtureOfAgents:
         self.rag.add_document(message)
 
     def load_core_memory(self):
+        self._core_memory_json = None
         return self.agent_core_memory.load_core_memory(self.core_memory_file)
 
     def clear_core_memory(self):
         empty_core_memory = {"persona": {}, "user": {}, "scratchpad": {}}
         self.agent_core_memory.core_memory = empty_core_memory
         self.core_memory = empty_core_memory
-        
+        self._core_memory_json = None
+
         # Save the empty core memory to file
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        core_memory_file = os.path.join(current_dir, "MemoryAssistant", "core_memory.json")
-        with open(core_memory_file, "w") as f:
-            json.dump(empty_core_memory, f, indent=2)
-        
+        with open(self.core_memory_file, "w") as f:
+            json.dump(empty_core_memory, f, sort_keys=True, indent=2)
+
         return "Core memory cleared successfully."
 
     def edit_core_memory(self, section: str, key: str, value: str):
@@ -215,69 +596,131 @@ class OllamaMixtureOfAgents:
             self.core_memory[section] = {}
         self.core_memory[section][key] = value
         self.agent_core_memory.update_core_memory(self.core_memory)
+        self._core_memory_json = None
         return f"Core memory updated: {section}.{key} = {value}"
 
     def upload_document(self, file_path: str):
         try:
             file_extension = file_path.split('.')[-1].lower()
-            
+
             if file_extension == 'txt':
                 with open(file_path, 'r', encoding='utf-8') as file:
                     content = file.read()
+                if not content.strip():
+                    return "The file is empty or could not be read."
+                splits = self.splitter.split_text(content)
+                self.rag.add_documents(splits)
+                self.document_count += len(splits)
+                chunks_added = len(splits)
             elif file_extension == 'pdf':
-                content = self.read_pdf(file_path)
+                chunks_added = self._index_segments(self.read_pdf(file_path))
             elif file_extension == 'csv':
-                content = self.read_csv(file_path)
+                chunks_added = self._index_segments(self.read_csv(file_path))
             else:
                 return f"Unsupported file type: {file_extension}"
-            
-            if not content.strip():
+
+            if chunks_added == 0:
                 return "The file is empty or could not be read."
-            
-            splits = self.splitter.split_text(content)
-            for split in splits:
-                self.rag.add_document(split)
-                self.document_count += 1
-            
-            return f"Document {file_path} uploaded and processed successfully. Added {len(splits)} chunks to archival memory."
+
+            self.rag.save_state()
+            self._save_document_count()
+            return f"Document {file_path} uploaded and processed successfully. Added {chunks_added} chunks to archival memory."
         except Exception as e:
             return f"An error occurred while processing {file_path}: {str(e)}"
 
-    def read_pdf(self, file_path: str) -> str:
-        content = ""
+    def _index_segments(self, segments) -> int:
+        # Stream text segments into the splitter through a rolling buffer so the
+        # whole document never has to reside in memory at once; the last split of
+        # each flush is carried over in case a chunk straddles two segments
+        buffer = ""
+        chunks_added = 0
+        for segment in segments:
+            buffer += segment
+            if len(buffer) >= 2 * self.chunk_size:
+                splits = self.splitter.split_text(buffer)
+                buffer = splits.pop()
+                if splits:
+                    self.rag.add_documents(splits)
+                    self.document_count += len(splits)
+                    chunks_added += len(splits)
+        if buffer.strip():
+            splits = self.splitter.split_text(buffer)
+            self.rag.add_documents(splits)
+            self.document_count += len(splits)
+            chunks_added += len(splits)
+        return chunks_added
+
+    def read_pdf(self, file_path: str):
+        import PyPDF2
+
         with open(file_path, 'rb') as file:
             reader = PyPDF2.PdfReader(file)
             for page in reader.pages:
-                content += page.extract_text() + "\n\n"
-        return content
+                yield page.extract_text() + "\n\n"
 
-    def read_csv(self, file_path: str) -> str:
-        content = ""
+    def read_csv(self, file_path: str, rows_per_segment: int = 256):
         with open(file_path, 'r', newline='', encoding='utf-8') as file:
             reader = csv.reader(file)
+            rows = []
             for row in reader:
-                content += ",".join(row) + "\n"
-        return content
+                rows.append(row)
+                if len(rows) >= rows_per_segment:
+                    yield self._format_csv_rows(rows)
+                    rows = []
+            if rows:
+                yield self._format_csv_rows(rows)
+
+    def _save_document_count(self):
+        with open(self._count_file, "w") as f:
+            json.dump({"document_count": self.document_count}, f)
+
+    @staticmethod
+    def _format_csv_rows(rows) -> str:
+        segment = io.StringIO()
+        csv.writer(segment, lineterminator="\n").writerows(rows)
+        return segment.getvalue()
 
     async def get_response(self, input_message: str) -> Tuple[str, bool]:
         # Update memory with user input
         self.update_memory(input_message, Roles.user)
 
-        # Generate responses from reference agents concurrently
-        tasks = [agent.generate_response(input_message) for agent in self.reference_agents]
-        results = await asyncio.gather(*tasks)
-        
+        # Kick off every phase that doesn't depend on the reference responses at
+        # once — reference agents, query extension, web search and first-wave
+        # retrieval — so wall-clock is the max of the branches, not their sum
+        query_extension_agent = OllamaAgent(self.final_agent.model, "QueryExtensionAgent",
+            "You are a world class query extension algorithm capable of extending queries by writing new queries. Do not answer the queries, simply provide a list of additional queries in JSON format.")
+
+        k = min(3, max(1, self.document_count))
+        ref_task = asyncio.gather(*(agent.generate_response(input_message) for agent in self.reference_agents))
+        extension_task = asyncio.create_task(
+            query_extension_agent.generate_response(f"Consider the following query: {input_message}")
+        )
+        web_task = asyncio.create_task(search_web(input_message)) if self.web_search_enabled else None
+        rag_task = asyncio.create_task(_to_thread_fast(self.rag.retrieve_documents_batch, [input_message], k))
+
+        results = await ref_task
+
+
+        # Sort references by agent name so the prompt prefix is deterministic across
+        # calls regardless of the order asyncio.gather resolves in
         references = []
         web_search_performed = False
-        for response, search_performed in results:
+        for agent, (response, search_performed) in sorted(
+            zip(self.reference_agents, results), key=lambda pair: pair[0].name
+        ):
             if response is not None and not response.startswith("Error:"):
-                references.append(response)
+                references.append(f"### {agent.name}\n{response}")
             web_search_performed |= search_performed
-        
+
         if not references:
+            for task in (extension_task, web_task, rag_task):
+                if task is not None:
+                    task.cancel()
             return "Error: All reference agents failed to generate responses.", False
 
-        # Generate the final response using the aggregate model
+        # Build the final prompt with stable content (system prompt, persona, sorted
+        # references, memory) first, so backends can hit their prompt/KV cache on the
+        # shared prefix; everything tied to this specific query goes strictly at the end
         final_prompt = [
             {"role": "system", "content": self.final_agent.system_prompt},
         ]
@@ -290,23 +733,20 @@ class OllamaMixtureOfAgents:
                 final_prompt.append({"role": "system", "content": f"Personality: {personality}"})
 
         final_prompt.extend([
-            {"role": "user", "content": input_message},
-            {"role": "system", "content": "References:\n" + "\n".join(references)},
+            {"role": "system", "content": "References:\n" + "\n\n".join(references)},
             {"role": "system", "content": self.update_memory_section()}
         ])
 
-        if self.web_search_enabled:
-            search_results = search_web(input_message)
+        if web_task is not None:
+            search_results = await web_task
             if "Based on the following results:" in search_results:
                 web_search_performed = True
                 final_prompt.append({"role": "system", "content": f"Web Search Results:\n{search_results}"})
 
-        # Perform query extension
-        query_extension_agent = OllamaAgent(self.final_agent.model, "QueryExtensionAgent", 
-            "You are a world class query extension algorithm capable of extending queries by writing new queries. Do not answer the queries, simply provide a list of additional queries in JSON format.")
-        
-        extension_output, _ = await query_extension_agent.generate_response(f"Consider the following query: {input_message}")
-        
+        # Join the query extension started alongside the reference agents
+        extension_output, _ = await extension_task
+
+
         try:
             # Try to parse as a dictionary first
             extension_data = json.loads(extension_output)
@@ -324,40 +764,58 @@ class OllamaMixtureOfAgents:
             print(f"Error processing query extension: {str(e)}")
             queries = QueryExtension(queries=[])
 
-        # Retrieve relevant documents
-        prompt = "Consider the following context:\n==========Context===========\n"
-        documents = self.rag.retrieve_documents(input_message, k=min(3, max(1, self.document_count)))
-        if documents:
-            for doc in documents:
-                prompt += doc["content"] + "\n\n"
-        else:
-            prompt += "No relevant documents found in archival memory.\n\n"
-
-        for query_item in queries.queries:
-            documents = self.rag.retrieve_documents(query_item.query, k=min(3, max(1, self.document_count)))
-            if documents:
-                for doc in documents:
-                    if doc["content"] not in prompt:
-                        prompt += doc["content"] + "\n\n"
-        
-        prompt += "\n======================\nQuestion: " + input_message
-
-        # Use the final agent to generate the response
-        final_prompt = [
-            {"role": "system", "content": self.final_agent.system_prompt},
-            {"role": "user", "content": prompt},
-        ]
-
-        final_response = await asyncio.to_thread(
-            generate_with_references, 
-            self.final_agent.model, 
-            final_prompt, 
-            temperature=self.temperature, 
-            max_tokens=self.max_tokens
+        # First-wave retrieval for the input message ran concurrently; follow up
+        # with one batched retrieval for the extension queries
+        documents = await rag_task
+        extension_queries = [query_item.query for query_item in queries.queries]
+        if extension_queries:
+            documents += await _to_thread_fast(self.rag.retrieve_documents_batch, extension_queries, k)
+
+        # Dedup by content hash in a set and join the parts once, instead of
+        # substring scans over and repeated concatenation of the growing prompt
+        seen_docs = set()
+        context_parts = []
+        for doc in documents:
+            doc_key = hashlib.blake2b(doc["content"][:256].encode("utf-8")).hexdigest()
+            if doc_key not in seen_docs:
+                seen_docs.add(doc_key)
+                context_parts.append(doc["content"])
+        if not context_parts:
+            context_parts.append("No relevant documents found in archival memory.")
+
+        prompt = (
+            "Consider the following context:\n==========Context===========\n"
+            + "\n\n".join(context_parts)
+            + "\n\n\n======================\nQuestion: " + input_message
         )
+
+        # Use the final agent to generate the response; the retrieved context and
+        # question form the dynamic suffix of the prompt
+        final_prompt.append({"role": "user", "content": prompt})
+
+        cache = get_response_cache()
+        cache_key = cache.make_key(final_prompt)
+        # Synthesis gets its own namespace so semantic hits can't surface a
+        # reference agent's answer as the final response
+        cache_namespace = hashlib.blake2b(
+            f"synthesis\x00{self.final_agent.system_prompt}".encode("utf-8")
+        ).hexdigest()
+        final_response = cache.get(cache_key, input_message, cache_namespace)
+        if final_response is None:
+            final_response = await generate_with_references_async(
+                self.final_agent.model,
+                final_prompt,
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                client=self.http_client
+            )
+            if isinstance(final_response, str) and not final_response.startswith("Error:"):
+                cache.put(cache_key, input_message, final_response, cache_namespace)
         
-        # Update memory with assistant's response
+        # Update memory with assistant's response and flush the index state once
+        # for the whole turn
         self.update_memory(final_response, Roles.assistant)
+        self.rag.save_state()
 
         return final_response, web_search_performed
 
@@ -366,8 +824,10 @@ class OllamaMixtureOfAgents:
         return f"Web search {'enabled' if enabled else 'disabled'}"
 
     def update_memory_section(self):
-        query = self.agent_event_memory.event_memory_manager.session.query(Event).all()
-        return f"Archival Memories:{self.document_count}\nConversation History Entries:{len(query)}\n\nCore Memory Content:\n{json.dumps(self.core_memory, indent=2)}"
+        event_count = self.agent_event_memory.event_memory_manager.session.query(Event).count()
+        if self._core_memory_json is None:
+            self._core_memory_json = json.dumps(self.core_memory, sort_keys=True, indent=2)
+        return f"Archival Memories:{self.document_count}\nConversation History Entries:{event_count}\n\nCore Memory Content:\n{self._core_memory_json}"
 
     def search_archival_memory(self, query: str):
         return self.rag.retrieve_documents(query, k=5)
@@ -375,7 +835,9 @@ class OllamaMixtureOfAgents:
     def add_to_archival_memory(self, content: str):
         if content.strip():  # Check if content is not empty
             self.rag.add_document(content)
+            self.rag.save_state()
             self.document_count += 1
+            self._save_document_count()
             return f"Added to archival memory: {content}"
         return "Failed to add empty content to archival memory."
 
@@ -383,6 +845,7 @@ class OllamaMixtureOfAgents:
         try:
             self.rag.clear_documents()
             self.document_count = 0  # Reset document count when clearing
+            self._save_document_count()
             return "Archival memory cleared successfully."
         except Exception as e:
             return f"Error clearing archival memory: {str(e)}"
@@ -391,7 +854,9 @@ class OllamaMixtureOfAgents:
         # This is a simplified version. In a real-world scenario, you might want to implement
         # a more sophisticated editing mechanism in the RAG system.
         self.rag.add_document(new_content)
+        self.rag.save_state()
         self.document_count += 1  # Increment document count when adding a document
+        self._save_document_count()
         return f"New content '{new_content}' added to archival memory. Note: Old content not removed due to limitations of the current implementation."
 
     @property
@@ -405,27 +870,34 @@ class OllamaMixtureOfAgents:
 
 def create_default_agents():
     return {
-        "AnalyticalAgent": OllamaAgent(os.getenv("MODEL_REFERENCE_1"), "AnalyticalAgent", DEFAULT_PROMPTS["AnalyticalAgent"]),
-        "HistoricalContextAgent": OllamaAgent(os.getenv("MODEL_REFERENCE_2"), "HistoricalContextAgent", DEFAULT_PROMPTS["HistoricalContextAgent"]),
-        "ScienceTruthAgent": OllamaAgent(os.getenv("MODEL_REFERENCE_3"), "ScienceTruthAgent", DEFAULT_PROMPTS["ScienceTruthAgent"]),
+        "AnalyticalAgent": OllamaAgent(os.getenv("MODEL_REFERENCE_1"), "AnalyticalAgent", DEFAULT_PROMPTS["AnalyticalAgent"], use_search_protocol=True),
+        "HistoricalContextAgent": OllamaAgent(os.getenv("MODEL_REFERENCE_2"), "HistoricalContextAgent", DEFAULT_PROMPTS["HistoricalContextAgent"], use_search_protocol=True),
+        "ScienceTruthAgent": OllamaAgent(os.getenv("MODEL_REFERENCE_3"), "ScienceTruthAgent", DEFAULT_PROMPTS["ScienceTruthAgent"], use_search_protocol=True),
         "SynthesisAgent": OllamaAgent(os.getenv("MODEL_AGGREGATE"), "SynthesisAgent", DEFAULT_PROMPTS["SynthesisAgent"])
     }
 
+# Colour codes bound once at module level so the REPL loop does plain local/global
+# lookups instead of two attribute lookups plus a concat per print
+CYAN, YELLOW, MAGENTA, GREEN, RED, BLUE = Fore.CYAN, Fore.YELLOW, Fore.MAGENTA, Fore.GREEN, Fore.RED, Fore.BLUE
+BRIGHT, RESET = Style.BRIGHT, Style.RESET_ALL
+
+WELCOME_MESSAGE = f"""{CYAN}{BRIGHT}Welcome to the Vodalus Mixture of Agents Chat!
+{YELLOW}Available commands:
+  'exit' - End the conversation
+  'agents' - List available agents
+  'time' - Toggle response time display
+  'web' - Toggle web search functionality
+  'edit core [section] [key] [value]' - Edit core memory
+  'search archival [query]' - Search archival memory
+  'add archival [content]' - Add to archival memory
+  'clear archival' - Clear archival memory
+  'edit archival [old_content] [new_content]' - Edit archival memory
+  'upload [file_path]' - Upload and process a document
+  'clear core' - Clear core memory
+{RESET}"""
+
 def print_welcome_message():
-    print(Fore.CYAN + Style.BRIGHT + "Welcome to the Vodalus Mixture of Agents Chat!")
-    print(Fore.YELLOW + "Available commands:")
-    print(Fore.YELLOW + "  'exit' - End the conversation")
-    print(Fore.YELLOW + "  'agents' - List available agents")
-    print(Fore.YELLOW + "  'time' - Toggle response time display")
-    print(Fore.YELLOW + "  'web' - Toggle web search functionality")
-    print(Fore.YELLOW + "  'edit core [section] [key] [value]' - Edit core memory")
-    print(Fore.YELLOW + "  'search archival [query]' - Search archival memory")
-    print(Fore.YELLOW + "  'add archival [content]' - Add to archival memory")
-    print(Fore.YELLOW + "  'clear archival' - Clear archival memory")
-    print(Fore.YELLOW + "  'edit archival [old_content] [new_content]' - Edit archival memory")
-    print(Fore.YELLOW + "  'upload [file_path]' - Upload and process a document")
-    print(Fore.YELLOW + "  'clear core' - Clear core memory")
-    print(Style.RESET_ALL)
+    print(WELCOME_MESSAGE)
 
 async def main():
     init(autoreset=True)  # Initialize colorama
@@ -452,73 +924,73 @@ async def main():
     show_time = False
 
     while True:
-        user_input = input(Fore.GREEN + "\nYou: " + Style.RESET_ALL).strip()
+        user_input = input(f"{GREEN}\nYou: {RESET}").strip()
 
         if user_input.lower() == 'exit':
-            print(Fore.CYAN + "Thank you for using the Vodalus Mixture of Agents chat. Goodbye!")
+            print(f"{CYAN}Thank you for using the Vodalus Mixture of Agents chat. Goodbye!")
             break
         elif user_input.lower() == 'agents':
-            print(Fore.MAGENTA + "Available Agents:")
+            print(f"{MAGENTA}Available Agents:")
             for agent in mixture.reference_agents:
-                print(Fore.MAGENTA + f"  - {agent.name}")
-            print(Fore.MAGENTA + f"  - {mixture.final_agent.name} (Synthesis Agent)")
+                print(f"{MAGENTA}  - {agent.name}")
+            print(f"{MAGENTA}  - {mixture.final_agent.name} (Synthesis Agent)")
         elif user_input.lower() == 'time':
             show_time = not show_time
-            print(Fore.YELLOW + f"Response time display: {'On' if show_time else 'Off'}")
+            print(f"{YELLOW}Response time display: {'On' if show_time else 'Off'}")
         elif user_input.lower() == 'web':
             mixture.web_search_enabled = not mixture.web_search_enabled
-            print(Fore.YELLOW + f"Web search: {'Enabled' if mixture.web_search_enabled else 'Disabled'}")
+            print(f"{YELLOW}Web search: {'Enabled' if mixture.web_search_enabled else 'Disabled'}")
         elif user_input.lower().startswith('edit core'):
             try:
                 _, section, key, value = user_input.split(' ', 3)
                 mixture.edit_core_memory(section, key, value)
-                print(Fore.YELLOW + f"Core memory updated: {section}.{key} = {value}")
+                print(f"{YELLOW}Core memory updated: {section}.{key} = {value}")
             except ValueError:
-                print(Fore.RED + "Invalid format. Use: edit core [section] [key] [value]")
+                print(f"{RED}Invalid format. Use: edit core [section] [key] [value]")
         elif user_input.lower().startswith('search archival'):
             _, query = user_input.split(' ', 1)
             results = mixture.search_archival_memory(query)
-            print(Fore.YELLOW + f"Archival memory search results for '{query}':")
+            print(f"{YELLOW}Archival memory search results for '{query}':")
             for i, result in enumerate(results, 1):
-                print(Fore.YELLOW + f"{i}. {result['content'][:100]}...")
+                print(f"{YELLOW}{i}. {result['content'][:100]}...")
         elif user_input.lower().startswith('add archival'):
             _, content = user_input.split(' ', 1)
             result = mixture.add_to_archival_memory(content)
-            print(Fore.YELLOW + result)
+            print(YELLOW + result)
         elif user_input.lower() == 'clear archival':
             result = mixture.clear_archival_memory()
-            print(Fore.YELLOW + result)
+            print(YELLOW + result)
         elif user_input.lower().startswith('edit archival'):
             try:
                 _, old_content, new_content = user_input.split(' ', 2)
                 result = mixture.edit_archival_memory(old_content, new_content)
-                print(Fore.YELLOW + result)
+                print(YELLOW + result)
             except ValueError:
-                print(Fore.RED + "Invalid format. Use: edit archival [old_content] [new_content]")
+                print(f"{RED}Invalid format. Use: edit archival [old_content] [new_content]")
         elif user_input.lower().startswith('upload'):
             _, file_path = user_input.split(' ', 1)
             try:
                 result = mixture.upload_document(file_path)
-                print(Fore.YELLOW + result)
+                print(YELLOW + result)
             except Exception as e:
-                print(Fore.RED + f"Error uploading document: {str(e)}")
+                print(f"{RED}Error uploading document: {str(e)}")
         elif user_input.lower() == 'clear core':
             result = mixture.clear_core_memory()
-            print(Fore.YELLOW + result)
+            print(YELLOW + result)
         else:
-            print(Fore.YELLOW + "Agents are thinking...")
+            print(f"{YELLOW}Agents are thinking...")
             start_time = time.time()
             response, web_search_performed = await mixture.get_response(user_input)
             end_time = time.time()
 
-            print(Fore.BLUE + "\nVodalus:" + Style.RESET_ALL, response)
-            
+            print(f"{BLUE}\nVodalus:{RESET}", response)
+
             if web_search_performed:
-                print(Fore.YELLOW + "\n[Web search was performed during response generation]")
+                print(f"{YELLOW}\n[Web search was performed during response generation]")
 
             if show_time:
                 elapsed_time = end_time - start_time
-                print(Fore.YELLOW + f"\nResponse Time: {elapsed_time:.2f} seconds")
+                print(f"{YELLOW}\nResponse Time: {elapsed_time:.2f} seconds")
 
 if __name__ == "__main__":
     asyncio.run(main())
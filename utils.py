@@ -1,7 +1,10 @@
 import os
 import json
 import time
+import asyncio
+import atexit
 import requests
+import httpx
 import openai
 import copy
 
@@ -21,6 +24,125 @@ TEMPERATURE = os.getenv("TEMPERATURE")
 
 DEBUG = int(os.environ.get("DEBUG", "0"))
 
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+
+_async_client = None
+
+
+def get_async_client():
+    """Return the shared httpx.AsyncClient so all async calls reuse one connection pool.
+
+    One warm client serves every outbound call (Ollama chat and web fetches), so
+    keepalive and HTTP/2 multiplexing spare the TLS handshake on repeat hosts.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+            http2=True,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+            timeout=httpx.Timeout(connect=5, read=60, write=10, pool=5),
+        )
+        atexit.register(_close_async_client)
+    return _async_client
+
+
+def _close_async_client():
+    global _async_client
+    if _async_client is not None:
+        client, _async_client = _async_client, None
+        try:
+            asyncio.run(client.aclose())
+        except RuntimeError:
+            pass
+
+
+async def generate_ollama_chat_async(
+    model,
+    messages,
+    max_tokens=MAX_TOKENS,
+    temperature=TEMPERATURE,
+    client=None,
+):
+    """Stream a chat completion from Ollama's native /api/chat endpoint.
+
+    All concurrent generations share the event loop and the pooled client
+    instead of each tying up a thread-pool worker for the full generation.
+    """
+    chat_model = model[0] if isinstance(model, list) else model
+
+    if client is None:
+        client = get_async_client()
+
+    output = None
+
+    for sleep_time in [1, 2, 4, 8, 16, 32]:
+        try:
+            endpoint = f"{OLLAMA_HOST}/api/chat"
+            logger.info(f"Sending request to {endpoint}")
+
+            # Convert temperature to float inside the try so a missing/invalid
+            # env value degrades to an "Error: ..." return like generate_together
+            temperature = float(temperature)
+
+            payload = {
+                "model": chat_model,
+                "messages": messages,
+                "stream": True,
+                "options": {
+                    "temperature": temperature if temperature > 1e-4 else 0,
+                    "num_predict": int(max_tokens),
+                    "cache_prompt": True,
+                },
+            }
+
+            chunks = []
+            async with client.stream("POST", endpoint, json=payload) as res:
+                res.raise_for_status()
+                async for line in res.aiter_lines():
+                    if not line.strip():
+                        continue
+                    data = json.loads(line)
+                    message = data.get("message") or {}
+                    chunks.append(message.get("content", ""))
+                    if data.get("done"):
+                        break
+            output = "".join(chunks)
+            break
+
+        except Exception as e:
+            logger.error(f"Error in generate_ollama_chat_async: {str(e)}")
+            output = f"Error: {str(e)}"
+            logger.info(f"Retry in {sleep_time}s..")
+            await asyncio.sleep(sleep_time)
+
+    if output is None:
+        return output
+
+    output = output.strip()
+    logger.info(f"Output: `{output[:20]}...`.")
+    return output
+
+
+async def generate_with_references_async(
+    model,
+    messages,
+    references=[],
+    max_tokens=MAX_TOKENS,
+    temperature=TEMPERATURE,
+    client=None,
+):
+    if len(references) > 0:
+        messages = inject_references_to_messages(messages, references)
+
+    return await generate_ollama_chat_async(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        client=client,
+    )
+
 
 def generate_together(
     model,